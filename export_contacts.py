@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 import sqlite3
-import json
 import os
+import pickle
+from collections import defaultdict
 from pathlib import Path
-from typing import Dict, List, Any
+from typing import Dict, Any
+import phonenumbers
+
+from utils import apply_read_only_pragmas, json_dumps
 
 def get_contacts_db_path() -> str:
     """Get the path to the Contacts SQLite database."""
@@ -20,61 +24,77 @@ def get_contacts_db_path() -> str:
     
     raise FileNotFoundError("Could not find Contacts database file (AddressBook-v22.abcddb)")
 
-def get_contacts() -> Dict[str, Dict[str, List[str]]]:
+def to_e164(phone: str) -> str:
+    """Format a phone number as E.164, keeping the original if it isn't a valid number."""
+    try:
+        parsed = phonenumbers.parse(phone, "US")
+    except phonenumbers.NumberParseException:
+        return phone
+    if not phonenumbers.is_valid_number(parsed):
+        return phone
+    return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
+
+def iter_rows(cursor: sqlite3.Cursor, batch_size: int = 1000):
+    """Yield the rows of an executed query, fetching them in batches."""
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+def get_contacts() -> Dict[str, Dict[str, Any]]:
     """Get all contacts from the macOS Contacts database and format them."""
     db_path = get_contacts_db_path()
     contacts_map = {}
 
-    # Connect to the SQLite database
-    conn = sqlite3.connect(db_path)
+    # Connect to the SQLite database read-only, tuned for a one-off full scan
+    conn = sqlite3.connect(f"{Path(db_path).as_uri()}?mode=ro", uri=True)
     cursor = conn.cursor()
+    apply_read_only_pragmas(cursor)
 
-    # Query to get names, phones, and emails
+    # Fetch phones and emails separately, keyed by the owning record, rather than
+    # joining both onto ZABCDRECORD (which yields a phones x emails row explosion).
+    # Dicts are used as insertion-ordered sets so the original number order is kept.
+    phones_by_pk = defaultdict(dict)
+    cursor.execute("SELECT ZOWNER, ZFULLNUMBER FROM ZABCDPHONENUMBER WHERE ZFULLNUMBER <> ''")
+    for owner, phone in iter_rows(cursor):
+        phones_by_pk[owner][to_e164(phone)] = None
+
+    emails_by_pk = defaultdict(dict)
+    # Lowercase in Python: SQLite's lower() only folds ASCII characters
+    cursor.execute("SELECT ZOWNER, ZADDRESS FROM ZABCDEMAILADDRESS WHERE ZADDRESS <> ''")
+    for owner, email in iter_rows(cursor):
+        emails_by_pk[owner][email.lower()] = None
+
+    # Query to get names
     query = """
-    SELECT 
-        ZABCDRECORD.ZFIRSTNAME, 
-        ZABCDRECORD.ZLASTNAME,
-        ZABCDPHONENUMBER.ZFULLNUMBER,
-        ZABCDEMAILADDRESS.ZADDRESS
+    SELECT Z_PK, ZFIRSTNAME, ZLASTNAME
     FROM ZABCDRECORD
-    LEFT JOIN ZABCDPHONENUMBER ON ZABCDRECORD.Z_PK = ZABCDPHONENUMBER.ZOWNER
-    LEFT JOIN ZABCDEMAILADDRESS ON ZABCDRECORD.Z_PK = ZABCDEMAILADDRESS.ZOWNER
-    WHERE ZABCDRECORD.ZFIRSTNAME IS NOT NULL OR ZABCDRECORD.ZLASTNAME IS NOT NULL
+    WHERE ZFIRSTNAME IS NOT NULL OR ZLASTNAME IS NOT NULL
     """
 
     cursor.execute(query)
-    results = cursor.fetchall()
-
-    # Process results
-    for row in results:
-        first_name = row[0] or ""
-        last_name = row[1] or ""
-        phone = row[2]
-        email = row[3]
 
+    # Process results, merging records that share the same full name
+    merged = defaultdict(lambda: ({}, {}))
+    for pk, first_name, last_name in iter_rows(cursor):
         # Create full name
-        name = f"{first_name} {last_name}".strip()
+        name = f"{first_name or ''} {last_name or ''}".strip()
         if not name:
             continue
 
-        # Initialize contact if not exists
-        if name not in contacts_map:
-            contacts_map[name] = {
-                "phones": [],
-                "emails": []
-            }
-
-        # Add phone if exists and not already added
-        if phone and phone not in contacts_map[name]["phones"]:
-            contacts_map[name]["phones"].append(phone)
-
-        # Add email if exists and not already added
-        if email and email.lower() not in contacts_map[name]["emails"]:
-            contacts_map[name]["emails"].append(email.lower())
+        phones, emails = merged[name]
+        phones.update(phones_by_pk.get(pk, {}))
+        emails.update(emails_by_pk.get(pk, {}))
 
     # Remove contacts with no phones or emails
-    contacts_map = {k: v for k, v in contacts_map.items() 
-                   if v["phones"] or v["emails"]}
+    for name, (phones, emails) in merged.items():
+        if phones or emails:
+            contacts_map[name] = {
+                "phones": list(phones),
+                "emails": list(emails),
+                "name_lower": name.lower()
+            }
 
     conn.close()
     return contacts_map
@@ -85,8 +105,12 @@ def main():
         contacts_map = get_contacts()
         
         # Write to JSON file
-        with open('contacts_map.json', 'w', encoding='utf-8') as f:
-            json.dump(contacts_map, f, indent=2, ensure_ascii=False)
+        with open('contacts_map.json', 'wb') as f:
+            f.write(json_dumps(contacts_map, indent=True))
+
+        # Write the pickle sidecar after the JSON so the server sees it as up to date
+        with open('contacts_map.pkl', 'wb') as f:
+            pickle.dump(contacts_map, f, protocol=5)
         
         print(f"Successfully exported {len(contacts_map)} contacts to contacts_map.json")
     
@@ -1,26 +1,37 @@
 from pathlib import Path
 import os
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Set, Tuple, TYPE_CHECKING
 from mcp.server.fastmcp import FastMCP
 from mcp.server.lowlevel.server import InitializationOptions
+from collections import OrderedDict
 from datetime import datetime, timedelta
-import imessagedb
-import phonenumbers
+import atexit
 import contextlib
-import io
+import functools
+import re
+import time
 import logging
 import sys
-import json
+import pickle
+import queue
 import logging.handlers
 
+from utils import apply_read_only_pragmas, json_dumps, json_loads
+
+# imessagedb and phonenumbers are imported where they are used, so server
+# startup doesn't pay for loading them (phonenumbers ships ~20 MB of metadata)
+if TYPE_CHECKING:
+    from imessagedb.message import Message
+
 # Create logs directory if it doesn't exist
 CLAUDE_LOG_PATH = Path.home() / "Library" / "Logs" / "Claude"
 CLAUDE_LOG_PATH.mkdir(parents=True, exist_ok=True)
 
-# Set up logging configuration
-logging.basicConfig(level=logging.DEBUG)  # Set root logger to DEBUG
+# Set up logging configuration; debug logging is opt-in via IMESSAGE_DEBUG=1
+LOG_LEVEL = logging.DEBUG if os.environ.get("IMESSAGE_DEBUG") == "1" else logging.INFO
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger("iMessage_Query")
-logger.setLevel(logging.DEBUG)
+logger.setLevel(LOG_LEVEL)
 
 # Clear any existing handlers
 logger.handlers = []
@@ -54,24 +65,76 @@ console_handler = logging.StreamHandler(sys.stderr)
 console_handler.setFormatter(simple_formatter)
 console_handler.setLevel(logging.INFO)
 
-# Add all handlers
-logger.addHandler(claude_handler)
-logger.addHandler(debug_handler)
-logger.addHandler(console_handler)
+# Hand records to a background thread so tool calls don't block on file I/O
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue, claude_handler, debug_handler, console_handler, respect_handler_level=True
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+# Don't also hand records to the root logger's synchronous stderr handler
+logger.propagate = False
 
 logger.info("Starting iMessage Query server with enhanced logging")
 
 # Load contacts map
 CONTACTS_MAP_PATH = Path(__file__).parent / "contacts_map.json"
-contacts_map: Dict[str, Dict[str, List[str]]] = {}
+# Pickled copy of the map written by export_contacts, much faster to load than JSON
+CONTACTS_CACHE_PATH = CONTACTS_MAP_PATH.with_suffix(".pkl")
+contacts_map: Dict[str, Dict[str, Any]] = {}
+
+# Lookup indexes derived from contacts_map, rebuilt whenever it is loaded
+_name_lower_index: List[Tuple[str, List[str]]] = []
+_exact_lower: Dict[str, List[str]] = {}
+_trigram_index: Dict[str, Set[int]] = {}
+
+def trigrams(text: str) -> Set[str]:
+    """Return the set of 3-character substrings of text."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+def build_name_index() -> None:
+    """Precompute lowercased name indexes so lookups don't rescan contacts_map."""
+    global _name_lower_index, _exact_lower, _trigram_index
+    # Exports include name_lower; maps from older exports are lowercased here instead
+    _name_lower_index = [
+        (info.get("name_lower") or name.lower(), info.get("phones", []))
+        for name, info in contacts_map.items()
+    ]
+    _exact_lower = {}
+    _trigram_index = {}
+    for i, (name_lower, phones) in enumerate(_name_lower_index):
+        _exact_lower.setdefault(name_lower, phones)
+        for gram in trigrams(name_lower):
+            _trigram_index.setdefault(gram, set()).add(i)
+
+def load_contacts_cache() -> bool:
+    """Load the contacts map from the pickle sidecar if it is at least as new as the JSON file."""
+    global contacts_map
+    if not CONTACTS_CACHE_PATH.exists():
+        return False
+    if CONTACTS_MAP_PATH.exists() and CONTACTS_CACHE_PATH.stat().st_mtime < CONTACTS_MAP_PATH.stat().st_mtime:
+        logger.info(f"Ignoring stale contacts cache at {CONTACTS_CACHE_PATH}")
+        return False
+    try:
+        with open(CONTACTS_CACHE_PATH, "rb") as f:
+            contacts_map = pickle.load(f)
+        return True
+    except Exception as e:
+        logger.warning(f"Error loading contacts cache, falling back to JSON: {e}")
+        return False
 
 def load_contacts_map() -> None:
-    """Load the contacts map from JSON file."""
+    """Load the contacts map from the pickle cache or the JSON file."""
     global contacts_map
     try:
-        if CONTACTS_MAP_PATH.exists():
-            with open(CONTACTS_MAP_PATH) as f:
-                contacts_map = json.load(f)
+        if load_contacts_cache():
+            build_name_index()
+            logger.info(f"Loaded contacts map with {len(contacts_map)} contacts from cache")
+        elif CONTACTS_MAP_PATH.exists():
+            with open(CONTACTS_MAP_PATH, "rb") as f:
+                contacts_map = json_loads(f.read())
+            build_name_index()
             logger.info(f"Loaded contacts map with {len(contacts_map)} contacts")
         else:
             logger.warning(f"Contacts map file not found at {CONTACTS_MAP_PATH}")
@@ -149,105 +212,229 @@ def lookup_contact_numbers(contact_name: str) -> Optional[List[str]]:
     if contact_name in contacts_map:
         return contacts_map[contact_name].get("phones", [])
         
-    # Try case-insensitive partial match
+    # Try case-insensitive exact match
     contact_name_lower = contact_name.lower()
-    for name, info in contacts_map.items():
-        if contact_name_lower in name.lower():
-            return info.get("phones", [])
+    if contact_name_lower in _exact_lower:
+        return _exact_lower[contact_name_lower]
+
+    # Fall back to case-insensitive partial match. Any name containing the query
+    # contains all of its trigrams, so only those candidates need checking.
+    if len(contact_name_lower) >= 3:
+        gram_sets = sorted((_trigram_index.get(gram, set()) for gram in trigrams(contact_name_lower)), key=len)
+        candidates = gram_sets[0].intersection(*gram_sets[1:])
+        for i in sorted(candidates):
+            name_lower, phones = _name_lower_index[i]
+            if contact_name_lower in name_lower:
+                return phones
+        return None
+
+    # Queries too short for trigrams are matched with a plain scan
+    for name_lower, phones in _name_lower_index:
+        if contact_name_lower in name_lower:
+            return phones
             
     return None
 
+# Contact map numbers already in E.164 form (as written by export_contacts) skip libphonenumber
+E164_RE = re.compile(r"\+\d{8,15}")
+
+@functools.lru_cache(maxsize=4096)
+def normalize_phone(raw: str) -> Optional[str]:
+    """Format a phone number as E.164.
+    
+    Args:
+        raw: Phone number in any format, assumed to be a US number if it has no country code
+        
+    Returns:
+        The E.164 formatted number, or None if it is not a valid phone number
+        
+    Raises:
+        phonenumbers.NumberParseException: If the input can't be parsed as a phone number
+    """
+    import phonenumbers
+    parsed = phonenumbers.parse(raw, "US")
+    if not phonenumbers.is_valid_number(parsed):
+        return None
+    return phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
+
+# Same columns as imessagedb.Messages, but with the date range applied in SQL
+MESSAGES_QUERY = """
+SELECT message.rowid, guid,
+    datetime(message.date/1000000000 + strftime('%s', '2001-01-01'), 'unixepoch', 'localtime'),
+    message.is_from_me, message.handle_id, message.attributedBody, message.message_summary_info,
+    message.text, reply_to_guid, thread_originator_guid, thread_originator_part
+FROM message
+WHERE message.rowid IN (
+    SELECT message_id FROM chat_message_join WHERE chat_id IN (
+        SELECT chat_id FROM chat_handle_join WHERE handle_id IN (
+            SELECT rowid FROM handle WHERE id = ?
+        )
+    )
+){date_clause}
+ORDER BY message.date ASC
+"""
+
+# Converts a local calendar day to the message.date representation (ns since 2001-01-01 UTC)
+APPLE_DAY_START = "(strftime('%s', ?, 'utc') - strftime('%s', '2001-01-01')) * 1000000000"
+APPLE_DAY_END = "(strftime('%s', ?, '+1 day', 'utc') - strftime('%s', '2001-01-01')) * 1000000000"
+
+FETCH_BATCH_SIZE = 500
+
+def fetch_messages(db, phone_number: str, start_day: Optional[str] = None, end_day: Optional[str] = None):
+    """Yield messages exchanged with a phone number, oldest first.
+    
+    Args:
+        db: Connected imessagedb.DB instance
+        phone_number: Handle id of the contact, as stored in the handle table
+        start_day: First local day (YYYY-MM-DD) to include, or None for no lower bound
+        end_day: Last local day (YYYY-MM-DD) to include, or None for no upper bound
+        
+    Returns:
+        Generator of imessagedb Message objects
+    """
+    date_rules = []
+    params = [phone_number]
+    if start_day:
+        date_rules.append(f"message.date >= {APPLE_DAY_START}")
+        params.append(start_day)
+    if end_day:
+        date_rules.append(f"message.date < {APPLE_DAY_END}")
+        params.append(end_day)
+    date_clause = f" AND {' AND '.join(date_rules)}" if date_rules else ""
+
+    from imessagedb.message import Message
+
+    message_join = db.attachment_list.message_join
+    cursor = db.connection
+    cursor.execute(MESSAGES_QUERY.format(date_clause=date_clause), params)
+    while True:
+        rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield Message(db, *row, None, message_join.get(row[0]))
+
+# Recent fetch_messages results, keyed by (phone number, start day, end day), in LRU order
+MESSAGES_CACHE_TTL = 60
+MESSAGES_CACHE_SIZE = 32
+_messages_cache: "OrderedDict[Tuple[str, Optional[str], Optional[str]], Tuple[float, List[Message]]]" = OrderedDict()
+
+def get_cached_messages(db, phone_number: str, start_day: Optional[str], end_day: Optional[str]) -> List["Message"]:
+    """Return fetch_messages results, reusing ones fetched in the last MESSAGES_CACHE_TTL seconds."""
+    key = (phone_number, start_day, end_day)
+    now = time.monotonic()
+    cached = _messages_cache.get(key)
+    if cached and now - cached[0] < MESSAGES_CACHE_TTL:
+        _messages_cache.move_to_end(key)
+        return cached[1]
+
+    messages = list(fetch_messages(db, phone_number, start_day, end_day))
+    _messages_cache[key] = (now, messages)
+    _messages_cache.move_to_end(key)
+    while len(_messages_cache) > MESSAGES_CACHE_SIZE:
+        _messages_cache.popitem(last=False)
+    return messages
+
+def attachment_to_dict(att: Any) -> Dict[str, Any]:
+    """Describe a message attachment, tolerating entries without attachment fields."""
+    return {
+        "mime_type": getattr(att, 'mime_type', None),
+        "filename": getattr(att, 'filename', None),
+        "file_path": getattr(att, 'original_path', None),
+        "is_missing": getattr(att, 'missing', False)
+    }
+
+def message_to_dict(msg: "Message") -> Dict[str, Any]:
+    """Describe a message for the transcript."""
+    attachments = msg.attachments
+    return {
+        "text": str(msg.text) if msg.text else "",
+        "date": msg.date,
+        # is_from_me is the raw 0/1 column value from chat.db
+        "is_from_me": msg.is_from_me == 1,
+        "has_attachments": attachments is not None and len(attachments) > 0,
+        "attachments": list(map(attachment_to_dict, attachments)) if attachments else []
+    }
+
+def encode_transcript(messages: List[Dict[str, Any]]) -> str:
+    """Serialize a transcript to JSON once, so FastMCP passes it through as text."""
+    transcript = {
+        "messages": messages,
+        "total_count": len(messages)
+    }
+    return json_dumps(transcript).decode("utf-8")
+
 # Register the tool
 @mcp.tool()
 def get_chat_transcript(
     contact: str,
     start_date: str = None,
     end_date: str = None
-) -> Dict[str, Any]:
+) -> str:
     """Get chat transcript for a contact (name or phone number) within a date range."""
-    logger.debug(f"get_chat_transcript called with contact={contact}, start_date={start_date}, end_date={end_date}")
+    import phonenumbers
+
+    logger.debug("get_chat_transcript called with contact=%s, start_date=%s, end_date=%s", contact, start_date, end_date)
     
     # First try to lookup contact in contacts map
     contact_numbers = lookup_contact_numbers(contact)
     if not contact_numbers:
         # If no contact found, check if input is already a phone number
         try:
-            parsed = phonenumbers.parse(contact, "US")
-            if phonenumbers.is_valid_number(parsed):
-                contact_numbers = [phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)]
-                logger.debug(f"Input was a valid phone number: {contact_numbers[0]}")
-            else:
-                logger.error(f"Could not find contact '{contact}' in contacts map and input is not a valid phone number")
-                raise ValueError(f"Could not find contact '{contact}' in contacts map and input is not a valid phone number")
+            normalized = normalize_phone(contact)
         except phonenumbers.NumberParseException:
             logger.error(f"Could not find contact '{contact}' in contacts map")
             raise ValueError(f"Could not find contact '{contact}' in contacts map")
+        if normalized is None:
+            logger.error(f"Could not find contact '{contact}' in contacts map and input is not a valid phone number")
+            raise ValueError(f"Could not find contact '{contact}' in contacts map and input is not a valid phone number")
+        contact_numbers = [normalized]
+        logger.debug("Input was a valid phone number: %s", contact_numbers[0])
         
-    logger.debug(f"Found contact {contact} with numbers: {contact_numbers}")
+    logger.debug("Found contact %s with numbers: %s", contact, contact_numbers)
     
     # Get messages using the first valid phone number found
     phone_number = contact_numbers[0]  # Use first number for now
     
-    # Format the phone number to E.164
-    try:
-        parsed = phonenumbers.parse(phone_number, "US")
-        if not phonenumbers.is_valid_number(parsed):
+    # Format the phone number to E.164, unless it already is: user input was
+    # normalized above, and export_contacts stores valid numbers as E.164
+    if not E164_RE.fullmatch(phone_number):
+        try:
+            normalized = normalize_phone(phone_number)
+        except phonenumbers.NumberParseException as e:
+            raise ValueError(f"Invalid phone number format: {e}")
+        if normalized is None:
             raise ValueError(f"Invalid phone number: {phone_number}")
-        phone_number = phonenumbers.format_number(parsed, phonenumbers.PhoneNumberFormat.E164)
-        logger.debug(f"Formatted phone number: {phone_number}")
-    except phonenumbers.NumberParseException as e:
-        raise ValueError(f"Invalid phone number format: {e}")
+        phone_number = normalized
+    logger.debug("Formatted phone number: %s", phone_number)
 
     if not DB_PATH.exists():
         raise FileNotFoundError(f"Messages database not found at: {DB_PATH}")
 
-    # Suppress stdout to hide progress bars
-    with contextlib.redirect_stdout(io.StringIO()):
+    # Set default date range to last 7 days if not specified
+    if not start_date and not end_date:
+        end_dt = datetime.now()
+        start_dt = end_dt - timedelta(days=7)
+        start_date = start_dt.strftime("%Y-%m-%d")
+        end_date = end_dt.strftime("%Y-%m-%d")
+
+    # Only the calendar day of each bound matters, both ends inclusive. Each bound
+    # is parsed once per call, which also rejects dates SQLite can't interpret.
+    try:
+        start_day = datetime.fromisoformat(start_date).date().isoformat() if start_date else None
+        end_day = datetime.fromisoformat(end_date).date().isoformat() if end_date else None
+    except ValueError as e:
+        raise ValueError(f"Invalid date, expected ISO-8601 (YYYY-MM-DD): {e}")
+
+    # Suppress stdout to hide imessagedb's progress bars, which would otherwise
+    # corrupt the stdio transport. Writing to devnull discards them instead of
+    # buffering every frame in memory.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
         with MessageDBConnection() as db:
-            # Create Messages object for the phone number
-            messages = db.Messages("person", phone_number, numbers=[phone_number])
-            
-            # Set default date range to last 7 days if not specified
-            if not start_date and not end_date:
-                end_dt = datetime.now()
-                start_dt = end_dt - timedelta(days=7)
-                start_date = start_dt.strftime("%Y-%m-%d")
-                end_date = end_dt.strftime("%Y-%m-%d")
-            
-            # Filter messages by date if specified
-            filtered_messages = []
-            for msg in messages.message_list:
-                msg_date = datetime.strptime(msg.date[:10], "%Y-%m-%d")
-                
-                if start_date:
-                    start_dt = datetime.fromisoformat(start_date)
-                    if msg_date < start_dt:
-                        continue
-                        
-                if end_date:
-                    end_dt = datetime.fromisoformat(end_date)
-                    if msg_date > end_dt:
-                        continue
-                        
-                filtered_messages.append({
-                    "text": str(msg.text) if msg.text else "",
-                    "date": msg.date,
-                    "is_from_me": bool(msg.is_from_me),
-                    "has_attachments": bool(msg.attachments),
-                    "attachments": [
-                        {
-                            "mime_type": att.mime_type if hasattr(att, 'mime_type') else None,
-                            "filename": att.filename if hasattr(att, 'filename') else None,
-                            "file_path": att.original_path if hasattr(att, 'original_path') else None,
-                            "is_missing": att.missing if hasattr(att, 'missing') else False
-                        } for att in msg.attachments if isinstance(att, object)
-                    ] if msg.attachments else []
-                })
-            
-            return {
-                "messages": filtered_messages,
-                "total_count": len(filtered_messages)
-            }
+            messages = get_cached_messages(db, phone_number, start_day, end_day)
+            filtered_messages = list(map(message_to_dict, messages))
+
+    return encode_transcript(filtered_messages)
 
 class DatabaseContext:
     """Singleton context for managing database connections across tools."""
@@ -263,7 +450,10 @@ class DatabaseContext:
     def get_connection(self):
         """Get an imessagedb connection from the context."""
         if self._db is None:
+            import imessagedb
             self._db = imessagedb.DB(str(self.db_path))
+            # imessagedb opens the connection itself, so tune it once it exists
+            apply_read_only_pragmas(self._db.connection)
         return self._db
 
 class MessageDBConnection:
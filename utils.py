@@ -0,0 +1,35 @@
+"""Helpers shared by export_contacts.py and imessage_query_server.py."""
+import json
+import sqlite3
+from typing import Any
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, json_dumps/json_loads fall back to the stdlib
+    orjson = None
+
+# The Contacts and Messages databases are only ever read: forbid writes and
+# favour a large page cache and memory-mapped I/O for full scans
+READ_ONLY_PRAGMAS = [
+    "PRAGMA query_only = 1",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA temp_store = MEMORY",
+]
+
+def apply_read_only_pragmas(cursor: sqlite3.Cursor) -> None:
+    """Apply READ_ONLY_PRAGMAS to the connection behind a cursor."""
+    for pragma in READ_ONLY_PRAGMAS:
+        cursor.execute(pragma)
+
+def json_dumps(obj: Any, indent: bool = False) -> bytes:
+    """Serialize obj to UTF-8 JSON, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode("utf-8")
+
+def json_loads(data: bytes) -> Any:
+    """Parse UTF-8 JSON, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)